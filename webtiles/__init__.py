@@ -1 +1,4 @@
 from .connection import *
+from .lobby import *
+from .watch import *
+from .shard import *
@@ -0,0 +1,269 @@
+"""
+Aggregate the lobbies of several WebTiles servers into a single index.
+
+"""
+
+import asyncio
+import bisect
+import logging
+
+from .connection import WebTilesConnection
+
+_log = logging.getLogger("webtiles")
+
+class LobbyConnection(WebTilesConnection):
+    """A lobby-only connection that reports every change to its lobby entries
+    to a `LobbyAggregator`. Each entry dict gets the additional key 'server'
+    holding the server name this connection was created with.
+
+    """
+
+    def __init__(self, aggregator, server):
+        super().__init__()
+        self.aggregator = aggregator
+        self.server = server
+
+    def update_lobby_entries(self, entries):
+        for entry in entries:
+            entry["server"] = self.server
+        super().update_lobby_entries(entries)
+        for entry in entries:
+            cur_entry = self.get_lobby_entry(entry["username"],
+                                             entry["game_id"])
+            if cur_entry:
+                self.aggregator.update_entry(cur_entry)
+
+    def remove_lobby_entry(self, process_id):
+        for entry in self.lobby_entries:
+            if entry["id"] == process_id:
+                self.aggregator.remove_entry(entry)
+                break
+        super().remove_lobby_entry(process_id)
+
+    @asyncio.coroutine
+    def handle_message(self, message):
+        if message["msg"] == "lobby_clear":
+            self.aggregator.clear_server(self.server)
+
+        handled = yield from super().handle_message(message)
+        return handled
+
+
+class LobbyAggregator():
+    """Keep lobby connections to a set of WebTiles servers and merge their
+    lobby entries into one index.
+
+    The `servers` argument is a dict with each key a server name and each
+    value a tuple of the websocket URL and protocol version, in the same form
+    as the `known_servers` table of `updaterc.py`. Call `start()` to connect to
+    every server and keep reading lobby data until `stop()` is called. A
+    server whose connection fails is retried after `reconnect_delay` seconds,
+    and its entries are dropped from the index in the meantime.
+
+    Entries are the lobby entry dicts of the underlying `LobbyConnection`
+    instances, and are identified by a key tuple of server name, username and
+    game id. They can be looked up without scanning by player with
+    `get_player_entries()`, by game id with `get_game_id_entries()`, and by
+    server with `get_server_entries()`. Player lookups are case-insensitive.
+    The games with the most spectators are available from `top_spectated()`,
+    which reads from a ranking kept sorted by spectator count as entries
+    change.
+
+    """
+
+    def __init__(self, servers, username=None, password=None,
+                 reconnect_delay=30):
+        self.servers = servers
+        self.username = username
+        self.password = password
+        self.reconnect_delay = reconnect_delay
+        self.connections = {}
+        self.tasks = []
+        self.running = False
+        self.entries = {}
+        self.player_index = {}
+        self.game_id_index = {}
+        self.server_index = {}
+        self._ranking = []
+        self._ranked_counts = {}
+
+    @staticmethod
+    def entry_key(entry):
+        """Return the index key tuple of the given lobby entry."""
+
+        return (entry["server"], entry["username"], entry["game_id"])
+
+    def _add_to_index(self, index, index_key, key):
+        if index_key not in index:
+            index[index_key] = set()
+        index[index_key].add(key)
+
+    def _remove_from_index(self, index, index_key, key):
+        keys = index.get(index_key)
+        if not keys:
+            return
+        keys.discard(key)
+        if not keys:
+            del index[index_key]
+
+    def _unrank(self, key):
+        count = self._ranked_counts.pop(key, None)
+        if count is None:
+            return
+        rank_item = (-count,) + key
+        pos = bisect.bisect_left(self._ranking, rank_item)
+        if pos < len(self._ranking) and self._ranking[pos] == rank_item:
+            del self._ranking[pos]
+
+    def _rank(self, key, count):
+        self._ranked_counts[key] = count
+        bisect.insort(self._ranking, (-count,) + key)
+
+    def update_entry(self, entry):
+        """Add or update a lobby entry in the index. This is called by
+        `LobbyConnection` and the entry must have a 'server' key.
+
+        """
+
+        key = self.entry_key(entry)
+        if key not in self.entries:
+            server, username, game_id = key
+            self._add_to_index(self.player_index, username.lower(), key)
+            self._add_to_index(self.game_id_index, game_id, key)
+            self._add_to_index(self.server_index, server, key)
+        self.entries[key] = entry
+
+        count = entry.get("spectator_count", 0)
+        if self._ranked_counts.get(key) != count:
+            self._unrank(key)
+            self._rank(key, count)
+
+    def remove_entry(self, entry):
+        """Remove a lobby entry from the index if present."""
+
+        key = self.entry_key(entry)
+        if key not in self.entries:
+            return
+
+        server, username, game_id = key
+        del self.entries[key]
+        self._remove_from_index(self.player_index, username.lower(), key)
+        self._remove_from_index(self.game_id_index, game_id, key)
+        self._remove_from_index(self.server_index, server, key)
+        self._unrank(key)
+
+    def clear_server(self, server):
+        """Remove all entries of the given server from the index."""
+
+        for key in list(self.server_index.get(server, ())):
+            self.remove_entry(self.entries[key])
+
+    def get_entry(self, server, username, game_id):
+        """Get the lobby entry for a game on a server, or None if there's no
+        such game in the index.
+
+        """
+
+        return self.entries.get((server, username, game_id))
+
+    def get_player_entries(self, username):
+        """Return a list of the lobby entries of games the given player is
+        currently playing, across all servers.
+
+        """
+
+        keys = self.player_index.get(username.lower(), ())
+        return [self.entries[k] for k in keys]
+
+    def get_game_id_entries(self, game_id):
+        """Return a list of the lobby entries with the given game id."""
+
+        keys = self.game_id_index.get(game_id, ())
+        return [self.entries[k] for k in keys]
+
+    def get_server_entries(self, server):
+        """Return a list of the lobby entries of the given server."""
+
+        keys = self.server_index.get(server, ())
+        return [self.entries[k] for k in keys]
+
+    def top_spectated(self, count):
+        """Return a list of up to `count` lobby entries with the highest
+        spectator counts, in descending order.
+
+        """
+
+        return [self.entries[item[1:]] for item in self._ranking[:count]]
+
+    @asyncio.coroutine
+    def _disconnect_server(self, server):
+        conn = self.connections[server]
+        self.clear_server(server)
+        try:
+            yield from conn.disconnect()
+        except Exception:
+            conn.websocket = None
+
+    @asyncio.coroutine
+    def _run_server(self, server):
+        websocket_url, protocol_version = self.servers[server]
+        conn = LobbyConnection(self, server)
+        self.connections[server] = conn
+
+        try:
+            while self.running:
+                try:
+                    if not conn.connected():
+                        yield from conn.connect(websocket_url, self.username,
+                                                self.password,
+                                                protocol_version)
+
+                    messages = yield from conn.read()
+                    if messages:
+                        for message in messages:
+                            yield from conn.handle_message(message)
+                    continue
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception as e:
+                    # Failures caused by stop() aren't errors.
+                    if not self.running:
+                        break
+                    err_reason = type(e).__name__
+                    if e.args:
+                        err_reason = e.args[0]
+                    _log.error("Lobby connection to %s failed: %s", server,
+                               err_reason)
+
+                yield from self._disconnect_server(server)
+                if self.running:
+                    yield from asyncio.sleep(self.reconnect_delay)
+
+        finally:
+            yield from self._disconnect_server(server)
+
+    @asyncio.coroutine
+    def start(self):
+        """Connect to every server and read lobby data until `stop()` is
+        called.
+
+        """
+
+        self.running = True
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self._run_server(s))
+                      for s in self.servers]
+        yield from asyncio.gather(*self.tasks, return_exceptions=True)
+
+    @asyncio.coroutine
+    def stop(self):
+        """Disconnect from all servers and clear the index."""
+
+        self.running = False
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            yield from asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
@@ -0,0 +1,415 @@
+"""
+Spread game connections over several worker processes, each running its own
+event loop.
+
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+
+from .connection import WebTilesError, WebTilesGameConnection
+
+_log = logging.getLogger("webtiles")
+
+class ShardWorker():
+    """The part of a `ShardCoordinator` that runs in a worker process. This
+    watches the games it's told to by the coordinator, each with its own
+    `WebTilesGameConnection`, and sends back a compact stream of events.
+
+    Commands are read from the `commands` queue as tuples of a command name and
+    a game key tuple of server name, username and game id. The command names
+    are "watch", "unwatch" and "stop", the latter taking None as its key.
+
+    Events are buffered and put on the worker's own `events` queue every
+    `flush_interval` seconds as a tuple of the worker id and a list of
+    events. Each event is a tuple of the event type, the game key and the
+    event data. The event types are "chat", with a tuple of sender and chat
+    text as data, "spectators", with a sorted tuple of spectator names,
+    "game_ended", with no data, and "watch_failed", with an error message. A
+    game that's left before watching starts gives "watch_failed".
+
+    """
+
+    def __init__(self, worker_id, servers, commands, events, username=None,
+                 password=None, flush_interval=0.5):
+        self.worker_id = worker_id
+        self.servers = servers
+        self.commands = commands
+        self.events = events
+        self.username = username
+        self.password = password
+        self.flush_interval = flush_interval
+        self.running = False
+        self.tasks = {}
+        self.pending_events = []
+
+    def emit(self, event_type, key, data=None):
+        """Queue an event to be sent on the next flush."""
+
+        self.pending_events.append((event_type, key, data))
+
+    def flush(self):
+        """Send all pending events to the coordinator."""
+
+        if self.pending_events:
+            self.events.put((self.worker_id, self.pending_events))
+            self.pending_events = []
+
+    def get_commands(self):
+        """Wait up to `flush_interval` seconds for a command, returning a list
+        of all commands available.
+
+        """
+
+        commands = []
+        try:
+            commands.append(self.commands.get(timeout=self.flush_interval))
+            while True:
+                commands.append(self.commands.get_nowait())
+        except queue.Empty:
+            pass
+        return commands
+
+    def left_game(self, message):
+        """Return True if the message tells us we're no longer in a game."""
+
+        return (message["msg"] == "game_ended"
+                # v1 of the protocol
+                or message["msg"] == "go_lobby"
+                # v2 protocol
+                or message["msg"] == "go" and message.get("path") == "/")
+
+    @asyncio.coroutine
+    def watch_game(self, key):
+        """Watch a game until it ends or the task is cancelled, emitting events
+        for chat messages, spectator changes and the end of the game.
+
+        """
+
+        server, username, game_id = key
+        websocket_url, protocol_version = self.servers[server]
+        conn = WebTilesGameConnection()
+        try:
+            yield from conn.connect(websocket_url, self.username,
+                                    self.password, protocol_version)
+            yield from conn.send_watch_game(username, game_id)
+            spectators = set()
+
+            while True:
+                messages = yield from conn.read()
+                if not messages:
+                    continue
+
+                for message in messages:
+                    was_watching = conn.watching
+                    yield from conn.handle_message(message)
+
+                    if message["msg"] == "chat":
+                        try:
+                            chat = conn.parse_chat_message(message)
+                        except WebTilesError as e:
+                            _log.debug(e.args[0])
+                            continue
+                        self.emit("chat", key, chat)
+
+                    if conn.spectators != spectators:
+                        spectators = set(conn.spectators)
+                        self.emit("spectators", key,
+                                  tuple(sorted(spectators)))
+
+                    if was_watching and not conn.watching:
+                        self.emit("game_ended", key)
+                        return
+
+                    # The server refused the watch, or the game ended
+                    # before watching started.
+                    if not conn.watching and self.left_game(message):
+                        self.emit("watch_failed", key,
+                                  "Left game before watching started")
+                        return
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception as e:
+            err_reason = type(e).__name__
+            if e.args:
+                err_reason = str(e.args[0])
+            self.emit("watch_failed", key, err_reason)
+
+        finally:
+            try:
+                yield from conn.disconnect()
+            except Exception:
+                pass
+
+    def handle_command(self, command, key):
+        """Start or stop watching a game as requested by the coordinator."""
+
+        if command == "watch":
+            task = self.tasks.get(key)
+            if not task or task.done():
+                loop = asyncio.get_event_loop()
+                self.tasks[key] = loop.create_task(self.watch_game(key))
+
+        elif command == "unwatch":
+            task = self.tasks.pop(key, None)
+            if task:
+                task.cancel()
+
+        elif command == "stop":
+            self.running = False
+
+    @asyncio.coroutine
+    def run(self):
+        """Handle commands and flush events until told to stop."""
+
+        loop = asyncio.get_event_loop()
+        self.running = True
+        while self.running:
+            commands = yield from loop.run_in_executor(None,
+                                                       self.get_commands)
+            for command, key in commands:
+                self.handle_command(command, key)
+
+            for key, task in list(self.tasks.items()):
+                if task.done():
+                    del self.tasks[key]
+            self.flush()
+
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            yield from asyncio.gather(*tasks, return_exceptions=True)
+        self.flush()
+
+
+def _worker_main(worker_id, servers, commands, events, username, password,
+                 flush_interval):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = ShardWorker(worker_id, servers, commands, events, username,
+                         password, flush_interval)
+    try:
+        loop.run_until_complete(worker.run())
+    finally:
+        loop.close()
+
+
+class ShardCoordinator():
+    """Spread game connections over `workers` processes (by default one per
+    CPU core), each running a `ShardWorker` with its own event loop.
+
+    The `servers` argument is a dict with each key a server name and each
+    value a tuple of the websocket URL and protocol version, as with
+    `LobbyAggregator`. Call `start()` to spawn the workers, then `watch()` and
+    `unwatch()` to assign games, which are identified by a key tuple of server
+    name, username and game id. New games go to the worker with the fewest
+    assigned games, and the current assignments are in the `assignments` dict.
+
+    Events from all workers are read with `get_events()`, or with the
+    coroutine `read_events()` from an event loop, and are described in
+    `ShardWorker`. Each worker has its own event queue, so a worker killed
+    while sending events can't corrupt the events of the others. Both methods
+    call `check_workers()` before waiting, which detects workers that have
+    died, spawns replacements if `respawn` is True, and reassigns the dead
+    worker's games. Games that end or fail to be watched are removed from the
+    assignments. All methods of the coordinator must be called from the same
+    thread.
+
+    """
+
+    def __init__(self, servers, workers=None, username=None, password=None,
+                 flush_interval=0.5, respawn=True, poll_interval=0.05):
+        self.servers = servers
+        self.workers = workers
+        if self.workers is None:
+            self.workers = multiprocessing.cpu_count()
+        self.username = username
+        self.password = password
+        self.flush_interval = flush_interval
+        self.respawn = respawn
+        self.poll_interval = poll_interval
+        self.processes = {}
+        self.command_queues = {}
+        self.event_queues = {}
+        self.assignments = {}
+
+    def _spawn(self, worker_id):
+        commands = multiprocessing.Queue()
+        events = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_worker_main,
+            args=(worker_id, self.servers, commands, events,
+                  self.username, self.password, self.flush_interval),
+            daemon=True)
+        process.start()
+        self.processes[worker_id] = process
+        self.command_queues[worker_id] = commands
+        self.event_queues[worker_id] = events
+
+    def start(self):
+        """Spawn the worker processes."""
+
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+
+    def stop(self, timeout=5):
+        """Tell every worker to stop, terminating any that haven't exited after
+        `timeout` seconds. Events sent by the workers while stopping are
+        discarded.
+
+        """
+
+        for commands in self.command_queues.values():
+            commands.put(("stop", None))
+
+        # A worker can't exit until its queued events are read, so keep
+        # draining the event queues while waiting.
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self._get_batches(list(self.event_queues.items()), 0)
+            alive = [p for p in self.processes.values() if p.is_alive()]
+            if not alive:
+                break
+            alive[0].join(min(self.poll_interval, deadline - time.time()))
+
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+        # Don't wait at exit to flush commands that no worker will read.
+        for commands in self.command_queues.values():
+            commands.cancel_join_thread()
+            commands.close()
+        for events in self.event_queues.values():
+            events.close()
+
+        self.processes = {}
+        self.command_queues = {}
+        self.event_queues = {}
+        self.assignments = {}
+
+    def watch(self, server, username, game_id):
+        """Assign a game to the least loaded worker. Does nothing if the game
+        is already assigned.
+
+        """
+
+        key = (server, username, game_id)
+        if key in self.assignments:
+            return
+
+        if not self.processes:
+            raise WebTilesError("Attempted to watch a game with no workers.")
+
+        loads = dict((w, 0) for w in self.processes)
+        for w in self.assignments.values():
+            if w in loads:
+                loads[w] += 1
+        worker_id = min(loads, key=lambda w: loads[w])
+
+        self.assignments[key] = worker_id
+        self.command_queues[worker_id].put(("watch", key))
+
+    def unwatch(self, server, username, game_id):
+        """Stop watching a game if it's assigned to a worker."""
+
+        key = (server, username, game_id)
+        worker_id = self.assignments.pop(key, None)
+        if worker_id is not None and worker_id in self.command_queues:
+            self.command_queues[worker_id].put(("unwatch", key))
+
+    def check_workers(self):
+        """Find workers that have died and reassign their games. Returns a list
+        of the ids of dead workers.
+
+        """
+
+        dead = [w for w, p in self.processes.items() if not p.is_alive()]
+        for worker_id in dead:
+            _log.error("Shard worker %s died with exit code %s", worker_id,
+                       self.processes[worker_id].exitcode)
+            del self.processes[worker_id]
+            del self.command_queues[worker_id]
+            # The dead worker may have left its event queue corrupted, so
+            # any unread events in it are dropped.
+            del self.event_queues[worker_id]
+            if self.respawn:
+                self._spawn(worker_id)
+
+        if not dead:
+            return dead
+
+        orphaned = [k for k, w in self.assignments.items() if w in dead]
+        for key in orphaned:
+            del self.assignments[key]
+            if self.processes:
+                self.watch(*key)
+            else:
+                _log.error("No shard workers left to watch %s on %s", key[1],
+                           key[0])
+        return dead
+
+    def _get_batches(self, event_queues, timeout):
+        # Wait for event batches from a list of (worker id, queue) pairs. This
+        # only reads the queues, so it's safe to run in an executor thread.
+        deadline = time.time() + timeout
+        while True:
+            batches = []
+            for worker_id, events in event_queues:
+                try:
+                    while True:
+                        batches.append((events, events.get_nowait()))
+                except queue.Empty:
+                    pass
+
+            remaining = deadline - time.time()
+            if batches or remaining <= 0:
+                return batches
+            time.sleep(min(self.poll_interval, remaining))
+
+    def _handle_batches(self, batches):
+        events = []
+        for events_queue, batch in batches:
+            worker_id, worker_events = batch
+            # Batches read from the queue of a worker since replaced don't
+            # affect the replacement's assignments.
+            current = self.event_queues.get(worker_id) is events_queue
+            for event in worker_events:
+                event_type, key, data = event
+                if (current
+                    and event_type in ("game_ended", "watch_failed")
+                    and self.assignments.get(key) == worker_id):
+                    del self.assignments[key]
+                events.append(event)
+        return events
+
+    def get_events(self, timeout=1):
+        """Check for dead workers, then wait up to `timeout` seconds for events
+        from the workers, returning a list of all events available. Events
+        come from workers in batches, so the list may hold many events.
+
+        """
+
+        self.check_workers()
+        batches = self._get_batches(list(self.event_queues.items()), timeout)
+        return self._handle_batches(batches)
+
+    @asyncio.coroutine
+    def read_events(self, timeout=1):
+        """Coroutine version of `get_events()`. Only the wait on the event
+        queues is done in an executor thread.
+
+        """
+
+        self.check_workers()
+        loop = asyncio.get_event_loop()
+        batches = yield from loop.run_in_executor(
+            None, self._get_batches, list(self.event_queues.items()), timeout)
+        return self._handle_batches(batches)
@@ -0,0 +1,351 @@
+"""
+Spectate the most interesting games across servers with a fixed pool of game
+connections.
+
+"""
+
+import asyncio
+import logging
+import time
+
+from .connection import WebTilesError, WebTilesGameConnection
+
+_log = logging.getLogger("webtiles")
+
+class WatchConnection(WebTilesGameConnection):
+    """A game connection used as one slot of a `WatchScheduler` pool. The
+    `target` property holds the key tuple of server name, username and game id
+    the scheduler has assigned to this slot, or None when the slot is free,
+    and `target_time` holds the time it was assigned. The `server` property is
+    the name of the server the websocket is currently connected to, and
+    `closing` is True while `disconnect()` is closing the websocket.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = None
+        self.target = None
+        self.target_time = None
+        self.target_score = 0
+        self.closing = False
+
+    @asyncio.coroutine
+    def disconnect(self):
+        self.closing = True
+        try:
+            yield from super().disconnect()
+        finally:
+            self.closing = False
+            self.server = None
+
+    def closed_by_us(self):
+        """Return True if the websocket has been or is being closed by
+        `disconnect()`.
+
+        """
+
+        return not self.websocket or self.closing
+
+
+class WatchScheduler():
+    """Move a fixed pool of `pool_size` game connections between the highest
+    scoring games in the lobbies of a `LobbyAggregator`. The aggregator must be
+    running for the scheduler to see any games.
+
+    Every `interval` seconds, the scheduler scores candidate games with
+    `score_entry()` and assigns the best of them to slots. Candidates are the
+    `candidate_limit` most spectated games (by default four times the pool
+    size) plus every game of a player in `watchlist`. A game that's been idle
+    for at least `max_idle` seconds, as given by `get_idle_time()`, is never a
+    candidate, and a slot watching such a game, or one that has left the
+    lobby, is freed immediately. Otherwise a slot keeps its game for at least
+    `min_dwell` seconds, after which it's only moved to a game with a better
+    score.
+
+    Moving a slot to another game on the same server is done with
+    `send_watch_game()`, and a slot that's freed with no replacement sends
+    `send_stop_watching()`. A slot moving to a different server reconnects.
+    The optional credentials are used when connecting game connections.
+
+    Connections are made by `new_connection()`, which can be overridden to
+    return a class derived from `WatchConnection` that handles chat or other
+    game messages.
+
+    """
+
+    def __init__(self, aggregator, pool_size, username=None, password=None,
+                 watchlist=(), watchlist_bonus=100, min_dwell=60,
+                 max_idle=300, candidate_limit=None, interval=5,
+                 reconnect_delay=30):
+        if max_idle <= 0:
+            raise WebTilesError("max_idle must be positive")
+
+        self.aggregator = aggregator
+        self.pool_size = pool_size
+        self.username = username
+        self.password = password
+        self.watchlist = set(p.lower() for p in watchlist)
+        self.watchlist_bonus = watchlist_bonus
+        self.min_dwell = min_dwell
+        self.max_idle = max_idle
+        self.candidate_limit = candidate_limit
+        if self.candidate_limit is None:
+            self.candidate_limit = 4 * pool_size
+        self.interval = interval
+        self.reconnect_delay = reconnect_delay
+        self.running = False
+        self.tasks = []
+        self.connections = [self.new_connection() for i in range(pool_size)]
+
+    def new_connection(self):
+        """Return a new connection to be used as a pool slot."""
+
+        return WatchConnection()
+
+    def get_idle_time(self, entry):
+        """Return the current idle time of the entry's game. The lobby's
+        'idle_time' is from the entry's last update, and servers only resend
+        an entry when the game becomes idle or active again, so for an idle
+        game we add the time since that update.
+
+        """
+
+        idle_time = entry.get("idle_time", 0)
+        if idle_time:
+            last_update = entry.get("time_last_update", time.time())
+            idle_time += max(0, time.time() - last_update)
+        return idle_time
+
+    def is_idle(self, entry):
+        """Return True if the entry's game has been idle long enough to be
+        evicted.
+
+        """
+
+        return self.get_idle_time(entry) >= self.max_idle
+
+    def score_entry(self, entry):
+        """Return the priority score of a lobby entry. The score is the
+        spectator count plus one, with `watchlist_bonus` added for watchlist
+        players, and scaled down linearly with the game's idle time.
+
+        """
+
+        score = entry.get("spectator_count", 0) + 1
+        if entry["username"].lower() in self.watchlist:
+            score += self.watchlist_bonus
+        idle_time = self.get_idle_time(entry)
+        return score * max(0, 1 - idle_time / self.max_idle)
+
+    def get_candidates(self):
+        """Return a dict of the scores of candidate games, keyed by lobby entry
+        key.
+
+        """
+
+        entries = self.aggregator.top_spectated(self.candidate_limit)
+        for player in self.watchlist:
+            entries.extend(self.aggregator.get_player_entries(player))
+
+        candidates = {}
+        for entry in entries:
+            if not self.is_idle(entry):
+                key = self.aggregator.entry_key(entry)
+                candidates[key] = self.score_entry(entry)
+        return candidates
+
+    @asyncio.coroutine
+    def _reset(self, conn):
+        try:
+            yield from conn.disconnect()
+        except Exception:
+            conn.websocket = None
+            conn.server = None
+
+    @asyncio.coroutine
+    def _assign(self, conn, key, score):
+        server, username, game_id = key
+        conn.target = key
+        conn.target_time = time.time()
+        conn.target_score = score
+
+        # If we need another server, the slot's reader reconnects.
+        if not conn.connected() or conn.server != server:
+            yield from self._reset(conn)
+            return
+
+        try:
+            yield from conn.send_watch_game(username, game_id)
+        except Exception as e:
+            _log.error("Unable to watch %s on %s: %s", username, server, e)
+            yield from self._reset(conn)
+
+    @asyncio.coroutine
+    def _release(self, conn):
+        conn.target = None
+        conn.target_time = None
+        conn.target_score = 0
+        if not conn.connected():
+            return
+
+        try:
+            yield from conn.send_stop_watching()
+        except Exception:
+            yield from self._reset(conn)
+
+    @asyncio.coroutine
+    def schedule(self):
+        """Score the current candidates and move slots between games. This is
+        called every `interval` seconds by `start()`.
+
+        """
+
+        current_time = time.time()
+        candidates = self.get_candidates()
+        desired = sorted(candidates, key=lambda k: candidates[k],
+                         reverse=True)[:self.pool_size]
+        desired_keys = set(desired)
+
+        free = []
+        replaceable = []
+        for conn in self.connections:
+            if not conn.target:
+                free.append(conn)
+                continue
+
+            entry = self.aggregator.get_entry(*conn.target)
+            if not entry or self.is_idle(entry):
+                yield from self._release(conn)
+                free.append(conn)
+                continue
+
+            conn.target_score = self.score_entry(entry)
+            if (conn.target not in desired_keys
+                and current_time - conn.target_time >= self.min_dwell):
+                replaceable.append(conn)
+
+        replaceable.sort(key=lambda c: c.target_score)
+        watched = set(c.target for c in self.connections if c.target)
+        for key in desired:
+            if key in watched:
+                continue
+
+            if free:
+                conn = free.pop()
+            elif replaceable and replaceable[0].target_score < candidates[key]:
+                conn = replaceable.pop(0)
+            else:
+                # Remaining targets score lower than every replaceable slot.
+                break
+
+            yield from self._assign(conn, key, candidates[key])
+
+    @asyncio.coroutine
+    def _connect_slot(self, conn):
+        server = conn.target[0]
+        websocket_url, protocol_version = self.aggregator.servers[server]
+        yield from conn.connect(websocket_url, self.username, self.password,
+                                protocol_version)
+        conn.server = server
+
+        # The target may have changed while we were connecting.
+        if not conn.target or conn.target[0] != server:
+            yield from self._reset(conn)
+            return
+
+        yield from conn.send_watch_game(conn.target[1], conn.target[2])
+
+    @asyncio.coroutine
+    def _run_slot(self, conn):
+        try:
+            yield from self._read_slot(conn)
+        finally:
+            yield from self._reset(conn)
+
+    @asyncio.coroutine
+    def _read_slot(self, conn):
+        while self.running:
+            if not conn.connected():
+                if not conn.target:
+                    yield from asyncio.sleep(self.interval)
+                    continue
+
+                server = conn.target[0]
+                try:
+                    yield from self._connect_slot(conn)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    _log.error("Unable to connect to %s: %s", server, e)
+                    yield from self._reset(conn)
+                    yield from asyncio.sleep(self.reconnect_delay)
+                    continue
+
+            try:
+                messages = yield from conn.read()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The scheduler closes the websocket itself when moving the
+                # slot to another server, so only log unexpected failures.
+                if not conn.closed_by_us():
+                    _log.error("Game connection to %s failed: %s",
+                               conn.server, e)
+                yield from self._reset(conn)
+                continue
+
+            if not messages:
+                continue
+
+            for message in messages:
+                # The scheduler may reset the connection partway through a
+                # batch, after which the rest of it is stale.
+                if conn.closed_by_us():
+                    break
+
+                try:
+                    yield from conn.handle_message(message)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if not conn.closed_by_us():
+                        _log.error("Unable to handle message from %s: %s",
+                                   conn.server, e)
+                    yield from self._reset(conn)
+                    break
+
+    @asyncio.coroutine
+    def _run_schedule(self):
+        while self.running:
+            yield from self.schedule()
+            yield from asyncio.sleep(self.interval)
+
+    @asyncio.coroutine
+    def start(self):
+        """Run the scheduler and the pool connections until `stop()` is
+        called.
+
+        """
+
+        self.running = True
+        loop = asyncio.get_event_loop()
+        self.tasks = [loop.create_task(self._run_schedule())]
+        self.tasks.extend(loop.create_task(self._run_slot(c))
+                          for c in self.connections)
+        yield from asyncio.gather(*self.tasks, return_exceptions=True)
+
+    @asyncio.coroutine
+    def stop(self):
+        """Stop scheduling and disconnect every pool connection."""
+
+        self.running = False
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            yield from asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+        for conn in self.connections:
+            conn.target = None
+            yield from self._reset(conn)